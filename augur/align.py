@@ -3,11 +3,27 @@ Align multiple sequences from FASTA.
 """
 
 import os
-from shutil import copyfile
+import mmap
+from shutil import copyfile, copyfileobj
+from types import SimpleNamespace
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from Bio import AlignIO, SeqIO, Seq, Align
+from Bio import AlignIO, SeqIO, Seq
+from Bio.SeqRecord import SeqRecord
 from .utils import run_shell_command, nthreads_value, shquote
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from itertools import chain, islice
+
+# number of aligned sequences postprocess holds in memory at once
+POSTPROCESS_BATCH_SIZE = 1000
+
+# characters which don't count as inserted bases, see collect_insertions
+NON_INSERTION_CHARS = b'-N?'
+NON_INSERTION_CODES = np.frombuffer(NON_INSERTION_CHARS, dtype=np.uint8)
+
+# location of a FASTA record in the file it was read from, see read_sequences
+FastaRecord = namedtuple("FastaRecord", ["name", "fname", "start", "end"])
 
 class AlignmentError(Exception):
     # TODO: this exception should potentially be renamed and made augur-wide
@@ -20,12 +36,13 @@ def register_arguments(parser):
     parser.add_argument('--output', '-o', default="alignment.fasta", help="output file (default: %(default)s)")
     parser.add_argument('--nthreads', type=nthreads_value, default=1,
                                 help="number of threads to use; specifying the value 'auto' will cause the number of available CPU cores on your system, if determinable, to be used")
-    parser.add_argument('--method', default='mafft', choices=["mafft"], help="alignment program to use")
+    parser.add_argument('--method', default='mafft', choices=["mafft", "mafft-reference"], help="alignment program to use; 'mafft-reference' adds the sequences to the existing alignment (e.g. just the reference sequence) using mafft's mode for closely related viral genomes (--addfragments), which requires mafft v7.470 or later and --existing-alignment")
     parser.add_argument('--reference-name', metavar="NAME", type=str, help="strip insertions relative to reference sequence; use if the reference is already in the input sequences")
     parser.add_argument('--reference-sequence', metavar="PATH", type=str, help="Add this reference sequence to the dataset & strip insertions relative to this. Use if the reference is NOT already in the input sequences")
     parser.add_argument('--remove-reference', action="store_true", default=False, help="remove reference sequence from the alignment")
     parser.add_argument('--fill-gaps', action="store_true", default=False, help="If gaps represent missing data rather than true indels, replace by N after aligning.")
     parser.add_argument('--existing-alignment', metavar="FASTA", default=False, help="An existing alignment to which the sequences will be added. The ouput alignment will be the same length as this existing alignment.")
+    parser.add_argument('--partition-size', metavar="N", type=int, help="Add the sequences to the existing alignment in groups of (at most) N sequences, running one aligner job per group concurrently and sharing --nthreads between them. Requires --existing-alignment.")
     parser.add_argument('--debug', action="store_true", default=False, help="Produce extra files (e.g. pre- and post-aligner files) which can help with debugging poor alignments.")
 
 def prepare(sequences, existing_aln_fname, output, ref_name, ref_seq_fname):
@@ -57,12 +74,16 @@ def prepare(sequences, existing_aln_fname, output, ref_name, ref_seq_fname):
     """
     seqs = read_sequences(*sequences)
     seqs_to_align_fname = output + ".to_align.fasta"
+    # sequences to write ahead of the input sequences
+    prepended_seqs = []
 
     if existing_aln_fname:
         existing_aln = read_alignment(existing_aln_fname)
+        existing_aln_names = [seq.name for seq in existing_aln]
         seqs = prune_seqs_matching_alignment(seqs, existing_aln)
     else:
         existing_aln = None
+        existing_aln_names = []
 
     if ref_seq_fname:
         ref_seq = read_reference(ref_seq_fname)
@@ -72,18 +93,20 @@ def prepare(sequences, existing_aln_fname, output, ref_name, ref_seq_fname):
                 raise AlignmentError("ERROR: Provided existing alignment ({}bp) is not the same length as the reference sequence ({}bp)".format(existing_aln.get_alignment_length(), len(ref_seq)))
             existing_aln_fname = existing_aln_fname + ".ref.fasta"
             existing_aln.append(ref_seq)
+            existing_aln_names.append(ref_seq.name)
             write_seqs(existing_aln, existing_aln_fname)
         else:
             # reference sequence needs to be the first one for auto direction
             # adjustment (auto reverse-complement)
-            seqs.insert(0, ref_seq)
+            prepended_seqs.append(ref_seq)
     elif ref_name:
         ensure_reference_strain_present(ref_name, existing_aln, seqs)
 
-    write_seqs(seqs, seqs_to_align_fname)
+    write_seqs(chain(prepended_seqs, seqs), seqs_to_align_fname)
 
     # 90% sure this is only ever going to catch ref_seq was a dupe
-    check_duplicates(existing_aln, seqs)
+    # (read_sequences has already made sure the input sequences' names are unique)
+    check_duplicates(existing_aln_names, (seq.name for seq in chain(prepended_seqs, seqs)))
     return existing_aln_fname, seqs_to_align_fname, ref_name
 
 def run(args):
@@ -114,16 +137,19 @@ def run(args):
 
         # generate alignment command & run
         log = args.output + ".log"
-        cmd = generate_alignment_cmd(args.method, args.nthreads, existing_aln_fname, seqs_to_align_fname, args.output, log)
-        success = run_shell_command(cmd)
-        if not success:
-            raise AlignmentError(f"Error during alignment: please see the log file {log!r} for more details")
+        if args.partition_size:
+            align_partitions(args.method, args.nthreads, args.partition_size, existing_aln_fname, seqs_to_align_fname, args.output, log)
+        else:
+            cmd = generate_alignment_cmd(args.method, args.nthreads, existing_aln_fname, seqs_to_align_fname, args.output, log)
+            success = run_shell_command(cmd)
+            if not success:
+                raise AlignmentError(f"Error during alignment: please see the log file {log!r} for more details")
 
         # after aligning, make a copy of the data that the aligner produced (useful for debugging)
         if args.debug:
             copyfile(args.output, args.output+".post_aligner.fasta")
 
-        postprocess(args.output, ref_name, not args.remove_reference, args.fill_gaps)
+        postprocess(args.output, ref_name, not args.remove_reference, args.fill_gaps, args.nthreads)
 
 
     except AlignmentError as e:
@@ -135,7 +161,7 @@ def run(args):
         os.remove(fname)
 
 
-def postprocess(output_file, ref_name, keep_reference, fill_gaps):
+def postprocess(output_file, ref_name, keep_reference, fill_gaps, nthreads=1):
     """Postprocessing of the combined alignment file.
 
     Parameters
@@ -148,43 +174,76 @@ def postprocess(output_file, ref_name, keep_reference, fill_gaps):
         If the reference was provided, whether it should be kept in the alignment
     fill_gaps: bool
         Replace all gaps in the alignment with "N" to indicate ambiguous sites.
+    nthreads: int
+        Number of threads to use when stripping insertions relative to the reference
 
     Returns
     -------
         None - the modified alignment is written directly to output_file
     """
     # -- ref_name --
-    # reads the new alignment
-    seqs = read_alignment(output_file)
-    # convert the aligner output to upper case and remove auto reverse-complement prefix
-    prettify_alignment(seqs)
-
-    # if we've specified a reference, strip out all the columns not present in the reference
-    # this will overwrite the alignment file
+    # if we've specified a reference, find which columns are present in it (all other columns will be stripped out)
+    # and where the runs of insertions relative to it are
+    needs_trim = False
     if ref_name:
-        seqs = strip_non_reference(seqs, ref_name, insertion_csv=output_file+".insertions.csv")
-        if not keep_reference:
-            seqs = remove_reference_sequence(seqs, ref_name)
-
-    if fill_gaps:
-        make_gaps_ambiguous(seqs)
-
-    # write the modified sequences back to the alignment file
-    write_seqs(seqs, output_file)
+        ungapped = reference_mask(find_reference(output_file, ref_name))
+        # without gaps in the reference there is nothing to strip (nor any insertions),
+        # so the sequences never need to be put into an array
+        needs_trim = not ungapped.all()
+        insertion_coords = np.stack(find_insertion_runs(ungapped), axis=1).tolist()
+        insertions = [defaultdict(list) for ins in insertion_coords]
+
+    def postprocessed_seqs():
+        # stream over the new alignment a batch of sequences at a time
+        seqs = iter_aligner_output(output_file)
+        while True:
+            batch = list(islice(seqs, POSTPROCESS_BATCH_SIZE))
+            if not batch:
+                break
+            # convert the aligner output to upper case and remove auto reverse-complement prefix
+            prettify_alignment(batch)
+            if needs_trim:
+                # gaps are filled while the sequences are still in the array (see strip_columns)
+                batch = strip_insertions(batch, ungapped, insertion_coords, insertions, nthreads, fill_gaps)
+            elif fill_gaps:
+                make_gaps_ambiguous(batch)
+            if ref_name and not keep_reference:
+                batch = remove_reference_sequence(batch, ref_name)
+            yield from batch
+
+    # write the modified sequences to a temporary file which then replaces the alignment file
+    tmp_file = output_file + ".postprocess.tmp"
+    try:
+        write_seqs(postprocessed_seqs(), tmp_file)
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
+    if ref_name:
+        if not needs_trim:
+            print("No gaps in alignment to trim (with respect to the reference, %s)"%ref_name)
+        else:
+            report_insertions(insertion_coords, insertions, output_file+".insertions.csv")
+            print("Trimmed gaps in", ref_name, "from the alignment")
 
 
 #####################################################################################################
 
 def read_sequences(*fnames):
-    """return list of sequences from all fnames"""
+    """return list of sequences from all fnames
+
+    Only the headers are parsed: each sequence is returned as a `FastaRecord`
+    giving its name and byte range in the file it came from. The sequence
+    itself is only read if another record has the same name.
+    """
     seqs = {}
     try:
         for fname in fnames:
-            for record in SeqIO.parse(fname, 'fasta'):
-                if record.name in seqs and record.seq != seqs[record.name].seq:
+            for record in index_fasta(fname):
+                if record.name in seqs and read_fasta_record(record) != read_fasta_record(seqs[record.name]):
                     raise AlignmentError("Detected duplicate input strains \"%s\" but the sequences are different." % record.name)
-                    # if the same sequence then we can proceed (and we only take one)
+                    # if the same sequence then we can proceed (and we only take the last one)
                 seqs[record.name] = record
     except FileNotFoundError:
         raise AlignmentError("\nCannot read sequences -- make sure the file %s exists and contains sequences in fasta format" % fname)
@@ -192,12 +251,40 @@ def read_sequences(*fnames):
         raise AlignmentError("\nERROR: Problem reading in {}: {}".format(fname, str(error)))
     return list(seqs.values())
 
+def index_fasta(fname):
+    """yield a `FastaRecord` for each sequence in fname, without parsing the sequences"""
+    with open(fname, 'rb') as fh:
+        name, start, offset = None, 0, 0
+        for line in fh:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield FastaRecord(name, fname, start, offset)
+                title = line[1:].decode('utf-8').split(None, 1)
+                name, start = title[0] if title else "", offset
+            offset += len(line)
+        if name is not None:
+            yield FastaRecord(name, fname, start, offset)
+
+def read_fasta_record(record):
+    """return the sequence of a `FastaRecord` as a string"""
+    with open(record.fname, 'rb') as fh:
+        fh.seek(record.start)
+        lines = fh.read(record.end - record.start).decode('utf-8').splitlines()
+    return "".join(line.rstrip() for line in lines[1:]).replace(" ", "")
+
 def check_arguments(args):
     # Simple error checking related to a reference name/sequence
     if args.reference_name and args.reference_sequence:
         raise AlignmentError("ERROR: You cannot provide both --reference-name and --reference-sequence")
     if args.remove_reference and not (args.reference_name or args.reference_sequence):
         raise AlignmentError("ERROR: You've asked to remove the reference but haven't specified one!")
+    if args.method == "mafft-reference" and not args.existing_alignment:
+        raise AlignmentError("ERROR: --method mafft-reference requires an --existing-alignment (which may just contain the reference sequence)")
+    if args.partition_size is not None:
+        if not args.existing_alignment:
+            raise AlignmentError("ERROR: --partition-size can only be used together with --existing-alignment")
+        if args.partition_size < 1:
+            raise AlignmentError("ERROR: --partition-size must be at least 1")
 
 def read_alignment(fname):
     try:
@@ -205,6 +292,49 @@ def read_alignment(fname):
     except Exception as error:
         raise AlignmentError("\nERROR: Problem reading in {}: {}".format(fname, str(error)))
 
+def iter_aligner_output(fname):
+    """Iterate over the aligned sequences written by the aligner as lightweight records.
+
+    Unlike `read_alignment`, this doesn't build a SeqRecord for each sequence:
+    every record only has the `id`, `name` and `description` attributes plus
+    the sequence itself as a plain string in `seq`. The file is memory-mapped and
+    split into records at each header, the line breaks within a (line-wrapped)
+    sequence are then removed in one go instead of collecting it line by line.
+    """
+    length = None
+    try:
+        with open(fname, 'rb') as fh:
+            # an empty file can't be memory-mapped (and has no records anyway)
+            if os.fstat(fh.fileno()).st_size:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # any text before the first header is ignored
+                    start = 0 if mm[:1] == b'>' else mm.find(b'\n>') + 1
+                    while start > 0 or mm[:1] == b'>':
+                        end = mm.find(b'\n>', start)
+                        header, _, body = mm[start+1:len(mm) if end == -1 else end+1].partition(b'\n')
+                        seq = body.translate(None, b' \r\n').decode('ascii')
+                        if length is None:
+                            length = len(seq)
+                        elif len(seq) != length:
+                            raise ValueError("Sequences must all be the same length")
+                        title = header.rstrip().decode('utf-8')
+                        name = title.split(None, 1)[0] if title else ""
+                        yield SimpleNamespace(id=name, name=name, description=title, seq=seq)
+                        if end == -1:
+                            break
+                        start = end + 1
+    except Exception as error:
+        raise AlignmentError("\nERROR: Problem reading in {}: {}".format(fname, str(error)))
+    if length is None:
+        raise AlignmentError("\nERROR: Problem reading in {}: No records found".format(fname))
+
+def find_reference(fname, reference):
+    """Return the reference sequence from the aligner output, allowing for an auto reverse-complement prefix"""
+    for seq in iter_aligner_output(fname):
+        if reference in (seq.name, seq.name[3:] if seq.name.startswith("_R_") else None):
+            return seq
+    raise AlignmentError("ERROR: reference %s not found in alignment"%reference)
+
 def ensure_reference_strain_present(ref_name, existing_alignment, seqs):
     if existing_alignment:
         if ref_name not in {x.name for x in existing_alignment}:
@@ -240,26 +370,89 @@ def generate_alignment_cmd(method, nthreads, existing_aln_fname, seqs_to_align_f
         print("\nusing mafft to align via:\n\t" + cmd +
               " \n\n\tKatoh et al, Nucleic Acid Research, vol 30, issue 14"
               "\n\thttps://doi.org/10.1093%2Fnar%2Fgkf436\n")
+    elif method=='mafft-reference':
+        if not existing_aln_fname:
+            raise AlignmentError("ERROR: --method mafft-reference requires an --existing-alignment (which may just contain the reference sequence)")
+        # reference-based alignment of closely related viral genomes, skipping the all-pairs
+        # distance calculation (https://mafft.cbrc.jp/alignment/software/closelyrelatedviralgenomes.html)
+        cmd = "mafft --auto --keeplength --anysymbol --addfragments %s --thread %d %s 1> %s 2> %s"%(shquote(seqs_to_align_fname), nthreads, shquote(existing_aln_fname), shquote(aln_fname), shquote(log_fname))
+        print("\nusing mafft (reference-based mode for closely related viral genomes, requires mafft >= 7.470) to align via:\n\t" + cmd +
+              " \n\n\tKatoh et al, Nucleic Acid Research, vol 30, issue 14"
+              "\n\thttps://doi.org/10.1093%2Fnar%2Fgkf436\n")
     else:
         raise AlignmentError('ERROR: alignment method %s not implemented'%method)
     return cmd
 
 
+def align_partitions(method, nthreads, partition_size, existing_aln_fname, seqs_to_align_fname, aln_fname, log_fname):
+    """Add the sequences to the existing alignment in partitions of `partition_size` sequences.
+
+    Each partition is aligned against the existing alignment by its own aligner
+    job and the jobs run concurrently, splitting `nthreads` between them. As the
+    existing alignment keeps its length (--keeplength), the new sequences from
+    every job can simply be appended to the output of the first one. The logs
+    of all jobs are combined into `log_fname`.
+    """
+    records = list(index_fasta(seqs_to_align_fname))
+    partitions = [records[i:i+partition_size] for i in range(0, len(records), partition_size)] or [[]]
+    njobs = min(len(partitions), max(nthreads, 1))
+    threads_per_job = max(nthreads // njobs, 1)
+
+    jobs = [("{}.part{}.fasta".format(aln_fname, idx),
+             "{}.part{}.aligned.fasta".format(aln_fname, idx),
+             "{}.part{}.log".format(aln_fname, idx)) for idx in range(len(partitions))]
+
+    def align_partition(job):
+        part_fname, part_aln_fname, part_log_fname = job
+        cmd = generate_alignment_cmd(method, threads_per_job, existing_aln_fname, part_fname, part_aln_fname, part_log_fname)
+        return run_shell_command(cmd)
+
+    try:
+        for partition, (part_fname, _, _) in zip(partitions, jobs):
+            write_seqs(partition, part_fname)
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            results = list(executor.map(align_partition, jobs))
+        if not all(results):
+            raise AlignmentError(f"Error during alignment: please see the log file {log_fname!r} for more details")
+
+        # every job's output contains the existing alignment, only keep it from the first one
+        existing_names = {record.name for record in index_fasta(existing_aln_fname)}
+        aligned = list(index_fasta(jobs[0][1]))
+        for _, part_aln_fname, _ in jobs[1:]:
+            aligned.extend(record for record in index_fasta(part_aln_fname) if record.name not in existing_names)
+        write_seqs(aligned, aln_fname)
+    finally:
+        # combine the logs (including those of failed jobs) and remove the partition files
+        with open(log_fname, 'wb') as log:
+            for _, _, part_log_fname in jobs:
+                if os.path.isfile(part_log_fname):
+                    with open(part_log_fname, 'rb') as part_log:
+                        copyfileobj(part_log, log)
+        for fname in chain.from_iterable(jobs):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
 def remove_reference_sequence(seqs, reference_name):
     return [seq for seq in seqs if seq.name!=reference_name]
 
 
-def strip_non_reference(aln, reference, insertion_csv=None):
+def strip_non_reference(aln, reference, insertion_csv=None, nthreads=1):
     '''
     return sequences that have all insertions relative to the reference
     removed. The aligment is returned as list of sequences.
 
     Parameters
     ----------
-    aln : MultipleSeqAlign
-        Biopython Alignment
+    aln : MultipleSeqAlign or list
+        Biopython Alignment, or the records from `iter_aligner_output`
+        (whose sequences are plain strings)
     reference : str
         name of reference sequence, assumed to be part of the alignment
+    insertion_csv : str, optional
+        if given, write the insertions (w.r.t. the reference) found in each sequence to this file
+    nthreads : int
+        number of threads to split the sequences across when removing the insertions
 
     Returns
     -------
@@ -281,51 +474,187 @@ def strip_non_reference(aln, reference, insertion_csv=None):
     '''
     seqs = {s.name:s for s in aln}
     if reference in seqs:
-        ref_array = np.array(seqs[reference])
-        if "-" not in ref_array:
+        ungapped = reference_mask(seqs[reference])
+        if ungapped.all():
             print("No gaps in alignment to trim (with respect to the reference, %s)"%reference)
-        ungapped = ref_array!='-'
-        ref_aln_array = np.array(aln)[:,ungapped]
+            # nothing to strip, so the sequences don't need to be put into an array
+            return list(aln)
     else:
         raise AlignmentError("ERROR: reference %s not found in alignment"%reference)
 
-    if False in ungapped and insertion_csv:
-        analyse_insertions(aln, ungapped, insertion_csv)
-
-    out_seqs = []
-    for seq, seq_array in zip(aln, ref_aln_array):
-        seq.seq = Seq.Seq(''.join(seq_array))
-        out_seqs.append(seq)
+    if insertion_csv:
+        ## Gather groups (runs) of insertions:
+        # python syntax - e.g. [0, 3, 5] means indexes 0,1 & 2 are insertions (w.r.t. ref), to the right of 0-based ref pos 5
+        insertion_coords = np.stack(find_insertion_runs(ungapped), axis=1).tolist()
+        insertions = [defaultdict(list) for ins in insertion_coords]
+        out_seqs = strip_insertions(aln, ungapped, insertion_coords, insertions, nthreads)
+        report_insertions(insertion_coords, insertions, insertion_csv)
+    else:
+        out_seqs = strip_insertions(aln, ungapped, nthreads=nthreads)
 
-    if "-" in ref_array:
-        print("Trimmed gaps in", reference, "from the alignment")
+    print("Trimmed gaps in", reference, "from the alignment")
 
     return out_seqs
 
-def analyse_insertions(aln, ungapped, insertion_csv):
-    ## Gather groups (runs) of insertions:
-    insertion_coords = [] # python syntax - e.g. [0, 3, 5] means indexes 0,1 & 2 are insertions (w.r.t. ref), to the right of 0-based ref pos 5
-    _open_idx = False
-    _ref_idx = -1
-    for i, in_ref in enumerate(ungapped):
-        if not in_ref and _open_idx is False:
-            _open_idx = i # insertion run start
-        elif in_ref and _open_idx is not False:
-            insertion_coords.append([_open_idx, i, _ref_idx])# insertion run has finished
-            _open_idx = False
-        if in_ref:
-            _ref_idx += 1
-    if _open_idx is not False:
-        insertion_coords.append([_open_idx, len(ungapped), _ref_idx])
-
-    # For each run of insertions (w.r.t. reference) collect the insertions we have
-    insertions = [defaultdict(list) for ins in insertion_coords]
-    for idx, insertion_coord in enumerate(insertion_coords):
-        for seq in aln:
-            s = seq[insertion_coord[0]:insertion_coord[1]].seq.ungap("-").ungap("N").ungap("?")
-            if len(s):
-                insertions[idx][str(s)].append(seq.name)
+def strip_insertions(aln, ungapped, insertion_coords=None, insertions=None, nthreads=1, fill_gaps=False):
+    '''
+    remove the insertions (w.r.t. the reference), i.e. the columns where `ungapped`
+    is False, from the sequences and return them as a list. This is shared by
+    `strip_non_reference` and `postprocess` (which calls it for each batch of sequences).
+
+    Parameters
+    ----------
+    aln : MultipleSeqAlign or list
+        Biopython Alignment, or the records from `iter_aligner_output`
+    ungapped : numpy.ndarray
+        boolean array with one entry per alignment column, False where the reference has a gap
+    insertion_coords : list, optional
+        the runs of insertions (see `find_insertion_runs`). If given, the insertions found in
+        the sequences are added to `insertions` (see `collect_insertions`) before being removed
+    insertions : list, optional
+        one dict per run of insertions, mapping each inserted sequence to the strains with it
+    nthreads : int
+        number of threads to split the sequences across when removing the insertions
+    fill_gaps : bool
+        also replace the gaps in the sequences by 'N' (see `strip_columns`)
+
+    Tests
+    -----
+    >>> [s.seq for s in strip_insertions(read_alignment("tests/data/align/test_aligned_sequences.fasta"), reference_mask(SeqRecord(Seq.Seq("---ATATA---"))))]
+    [Seq('ATATA'), Seq('ATATA'), Seq('ATCTA'), Seq('ATATA')]
+    '''
+    aln = list(aln)
+    aln_array = alignment_to_array(aln)
+    if insertion_coords is not None:
+        collect_insertions(aln, aln_array, insertion_coords, insertions)
+    for seq, stripped_seq in zip(aln, strip_columns(aln_array, ungapped, nthreads, fill_gaps)):
+        set_sequence(seq, stripped_seq)
+    return aln
+
+def reference_mask(reference):
+    '''
+    return a boolean array which is False for the alignment columns where the reference sequence has a gap.
+    '''
+    return np.frombuffer(str(reference.seq).encode('ascii'), dtype=np.uint8)!=ord('-')
+
+def strip_columns(aln_array, ungapped, nthreads=1, fill_gaps=False):
+    '''
+    return the rows of an alignment array (see `alignment_to_array`) as strings,
+    keeping only the columns where `ungapped` is True. If `fill_gaps` is True,
+    gaps are also replaced by 'N' (see `make_gaps_ambiguous_array`).
+
+    Tests
+    -----
+    >>> strip_columns(np.frombuffer(b"AC-GTAG-A", dtype=np.uint8).reshape(3, 3), np.array([True, False, True]))
+    ['A-', 'GA', 'GA']
+    >>> strip_columns(np.frombuffer(b"AC-GTAG-A", dtype=np.uint8).reshape(3, 3), np.array([True, False, True]), nthreads=2)
+    ['A-', 'GA', 'GA']
+    >>> strip_columns(np.frombuffer(b"AC-GTAG-A", dtype=np.uint8).reshape(3, 3), np.array([True, False, True]), fill_gaps=True)
+    ['AN', 'GA', 'GA']
+    '''
+    ungapped = np.asarray(ungapped, dtype=bool)
+    if nthreads > 1:
+        # numpy releases the GIL while copying the kept columns, so blocks of rows can be stripped concurrently
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            blocks = executor.map(lambda block: strip_columns(block, ungapped, fill_gaps=fill_gaps), np.array_split(aln_array, nthreads))
+            return [stripped_seq for block in blocks for stripped_seq in block]
+    # The kept columns come in a few long runs between the insertions (i.e. the runs of
+    # columns which are *not* missing from the reference). Copying each run as a slice into
+    # a preallocated array is several times faster than gathering columns via `ungapped`.
+    starts, ends, _ = find_insertion_runs(~ungapped)
+    stripped = np.empty((aln_array.shape[0], np.count_nonzero(ungapped)), dtype=np.uint8)
+    offset = 0
+    for start, end in zip(starts, ends):
+        stripped[:, offset:offset+end-start] = aln_array[:, start:end]
+        offset += end - start
+    if fill_gaps:
+        make_gaps_ambiguous_array(stripped)
+    # decode straight from each row's buffer rather than copying it into a bytes object first
+    return [str(row.data, 'ascii') for row in stripped]
+
+def alignment_to_array(aln):
+    '''
+    return the alignment as a 2D array of ASCII codes (dtype uint8), one row per sequence.
+
+    Each row is copied straight from the sequence's bytes rather than via
+    `np.array(aln)`, which builds a Python string for every single base.
+
+    Parameters
+    ----------
+    aln : MultipleSeqAlign or list
+        Biopython Alignment, or the records from `iter_aligner_output`
+        (whose sequences are plain strings)
+
+    Returns
+    -------
+    numpy.ndarray
+        array of shape (number of sequences, alignment length)
+
+    Tests
+    -----
+    >>> alignment_to_array(read_alignment("tests/data/align/test_aligned_sequences.fasta"))[0].tobytes()
+    b'---ATATA---'
+    '''
+    aln = list(aln)
+    aln_array = np.empty((len(aln), len(aln[0].seq) if aln else 0), dtype=np.uint8)
+    for row, seq in zip(aln_array, aln):
+        row[:] = np.frombuffer(str(seq.seq).encode('ascii'), dtype=np.uint8)
+    return aln_array
+
+def find_insertion_runs(ungapped):
+    '''
+    find the runs of insertions (w.r.t. the reference) in an alignment.
+
+    Parameters
+    ----------
+    ungapped : numpy.ndarray
+        boolean array with one entry per alignment column, False where the reference has a gap
 
+    Returns
+    -------
+    tuple of numpy.ndarray
+        the start (inclusive) and end (exclusive) column of each run and the
+        0-based reference position the run sits to the right of (-1 if the run
+        is at the start of the alignment)
+
+    Tests
+    -----
+    >>> [a.tolist() for a in find_insertion_runs(np.array([c != "-" for c in "--AT-G---C"]))]
+    [[0, 4, 6], [2, 5, 9], [-1, 1, 2]]
+    >>> [a.tolist() for a in find_insertion_runs(np.array([c != "-" for c in "ATG"]))]
+    [[], [], []]
+    '''
+    ungapped = np.asarray(ungapped, dtype=bool)
+    # Run boundaries are where `ungapped` flips value; padding with True (i.e. "in ref") on both sides
+    # means every run of insertions has a start (True -> False) and an end (False -> True).
+    flips = np.diff(np.concatenate(([1], ungapped.view(np.int8), [1])))
+    starts = np.flatnonzero(flips == -1)
+    ends = np.flatnonzero(flips == 1)
+    # 0-based ref position of each alignment column, so the base to the left of a run is ref_idx[start-1]
+    ref_idx = np.cumsum(ungapped) - 1
+    ref_idxs = np.where(starts > 0, ref_idx[starts - 1], -1)
+    return starts, ends, ref_idxs
+
+def collect_insertions(aln, aln_array, insertion_coords, insertions=None):
+    '''
+    For each run of insertions (w.r.t. reference) collect the insertions we have, i.e. the
+    strains with each inserted sequence. Adds to (and returns) `insertions` if given, so
+    that the alignment can be analysed in several parts. `aln` must be a list with the
+    sequences in the same order as the rows of `aln_array`.
+    '''
+    if insertions is None:
+        insertions = [defaultdict(list) for ins in insertion_coords]
+    for idx, insertion_coord in enumerate(insertion_coords):
+        run_array = aln_array[:, insertion_coord[0]:insertion_coord[1]]
+        # only the sequences with something other than gaps, Ns or ?s in this run have an insertion,
+        # so find those for all sequences at once and only then look at the inserted bases
+        has_insertion = ~np.isin(run_array, NON_INSERTION_CODES).all(axis=1)
+        for row in np.flatnonzero(has_insertion):
+            s = run_array[row].tobytes().translate(None, NON_INSERTION_CHARS).decode('ascii')
+            insertions[idx][s].append(aln[row].name)
+    return insertions
+
+def report_insertions(insertion_coords, insertions, insertion_csv):
     for insertion_coord, data in zip(insertion_coords, insertions):
         # GFF is 1-based & insertions are to the right of the base.
         print("{}bp insertion at ref position {}".format(insertion_coord[1]-insertion_coord[0], insertion_coord[2]+1))
@@ -356,19 +685,18 @@ def prettify_alignment(aln):
 
     Parameters
     ----------
-    aln : MultipleSeqAlign
-        Biopython Alignment
+    aln : MultipleSeqAlign or list
+        Biopython Alignment, or the records from `iter_aligner_output`
+        (whose sequences are plain strings)
     '''
     for seq in aln:
         seq.seq = seq.seq.upper()
-        # AlignIO.read repeats the ID in the name and description field
+        # the FASTA readers repeat the ID in the name and at the start of the description field,
+        # so the prefix only needs to be looked for once
         if seq.id.startswith("_R_"):
-            seq.id = seq.id[3:]
-            print("Sequence \"{}\" was reverse-complemented by the alignment program.".format(seq.id))
-        if seq.name.startswith("_R_"):
-            seq.name = seq.name[3:]
-        if seq.description.startswith("_R_"):
+            seq.id = seq.name = seq.id[3:]
             seq.description = seq.description[3:]
+            print("Sequence \"{}\" was reverse-complemented by the alignment program.".format(seq.id))
 
 
 def make_gaps_ambiguous(aln):
@@ -379,38 +707,75 @@ def make_gaps_ambiguous(aln):
 
     Parameters
     ----------
-    aln : MultipleSeqAlign
-        Biopython Alignment
+    aln : MultipleSeqAlign or list
+        Biopython Alignment, or the records from `iter_aligner_output`
+        (whose sequences are plain strings)
     '''
     for seq in aln:
-        _seq = str(seq.seq)
-        _seq = _seq.replace('-', 'N')
-        seq.seq = Seq.Seq(_seq)
+        set_sequence(seq, str(seq.seq).replace('-', 'N'))
 
 
-def check_duplicates(*values):
-    names = set()
-    def add(name):
-        if name in names:
+def set_sequence(record, seq):
+    '''
+    set the sequence of a record to the string `seq`. SeqRecords get a Seq object,
+    so that they can still be written by Biopython, while the lightweight records
+    from `iter_aligner_output` keep their sequence as a plain string.
+    '''
+    record.seq = Seq.Seq(seq) if isinstance(record, SeqRecord) else seq
+
+
+def make_gaps_ambiguous_array(aln_array):
+    '''
+    replace all gaps by 'N' in an alignment array (see `alignment_to_array`), in place.
+
+    Tests
+    -----
+    >>> aln_array = np.frombuffer(b"G-AC----", dtype=np.uint8).reshape(2, 4).copy()
+    >>> make_gaps_ambiguous_array(aln_array)
+    >>> aln_array.tobytes()
+    b'GNACNNNN'
+    '''
+    # '-' and 'N' differ by a fixed set of bits, so xor-ing those bits into every gap (and
+    # nothing into any other base) swaps one for the other in a single branchless pass
+    gaps = (aln_array == ord('-')).view(np.uint8)
+    np.bitwise_xor(aln_array, gaps * np.uint8(ord('-') ^ ord('N')), out=aln_array)
+
+
+def check_duplicates(*names):
+    """raise an AlignmentError if any name is seen more than once across the given iterables of names"""
+    seen = set()
+    for name in (name for group in names for name in group):
+        if name in seen:
             raise AlignmentError("Duplicate strains of \"{}\" detected".format(name))
-        names.add(name)
-    for sample in values:
-        if not sample:
-            # allows false-like values (e.g. always provide existing_alignment, allowing
-            # the default which is `False`)
-            continue
-        elif isinstance(sample, (list, Align.MultipleSeqAlignment)):
-            for s in sample:
-                add(s.name)
-        elif isinstance(sample, str):
-            add(sample)
-        else:
-            raise TypeError()
+        seen.add(name)
 
 def write_seqs(seqs, fname):
-    """A wrapper around SeqIO.write with error handling"""
+    """Write sequences to fname as FASTA (one line per sequence), with error handling
+
+    `seqs` can be any iterable (e.g. a generator), which is only iterated over once
+    and never turned into a list. Any record with `id`, `description` and `seq` attributes can be written,
+    the title follows the same rules as Biopython's FASTA writer.
+    `FastaRecord`s (see `read_sequences`) are copied verbatim from the file
+    they were read from rather than being parsed and formatted again.
+    """
     try:
-        SeqIO.write(seqs, fname, 'fasta')
+        with open(fname, 'wb', buffering=1<<20) as fh, ExitStack() as stack:
+            sources = {}
+            for seq in seqs:
+                if isinstance(seq, FastaRecord):
+                    if seq.fname not in sources:
+                        sources[seq.fname] = stack.enter_context(open(seq.fname, 'rb'))
+                    sources[seq.fname].seek(seq.start)
+                    record = sources[seq.fname].read(seq.end - seq.start)
+                    fh.write(record if record.endswith(b'\n') else record + b'\n')
+                else:
+                    if seq.description and seq.description.split(None, 1)[0] == seq.id:
+                        title = seq.description
+                    elif seq.description:
+                        title = seq.id + " " + seq.description
+                    else:
+                        title = seq.id
+                    fh.write(b'>' + title.encode('utf-8') + b'\n' + str(seq.seq).encode('ascii') + b'\n')
     except FileNotFoundError:
         raise AlignmentError('ERROR: Couldn\'t write "{}" -- perhaps the directory doesn\'t exist?'.format(fname))
 
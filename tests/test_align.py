@@ -4,7 +4,9 @@ import os
 
 import pytest
 import pathlib
+import numpy as np
 
+from collections import defaultdict
 from shlex import quote
 
 from Bio import SeqIO
@@ -103,11 +105,34 @@ class TestAlign:
             Seq("TAGC"),
         ]
 
+    def test_seq_records_stay_writable(self, out_file):
+        """SeqRecords modified by the postprocessing helpers should still hold Seq objects Biopython can write"""
+        data_file = pathlib.Path('tests/data/align/test_aligned_sequences.fasta')
+        alignment = align.read_alignment(str(data_file.resolve()))
+        seqs = align.strip_non_reference(alignment, "with_gaps")
+        align.make_gaps_ambiguous(seqs)
+        assert all(isinstance(seq.seq, Seq) for seq in seqs)
+        SeqIO.write(seqs, out_file, "fasta")
+        assert [str(record.seq) for record in SeqIO.parse(out_file, "fasta")] == ["ATATA", "ATATA", "ATCTA", "ATATA"]
+
+    def test_make_gaps_ambiguous_aligner_output(self):
+        data_file = pathlib.Path('tests/data/align/test_aligned_sequences.fasta')
+        alignment = list(align.iter_aligner_output(str(data_file.resolve())))
+
+        align.make_gaps_ambiguous(alignment)
+
+        assert [seq.seq for seq in alignment] == [
+            "NNNATATANNN",
+            "GGGATATAGGG",
+            "NNGATCTAGGG",
+            "NGGATATAGGN",
+        ]
+
     def test_check_duplicates_no_arguments(self):
         assert align.check_duplicates() is None
 
     def test_check_duplicates_strings_with_no_duplicates(self):
-        assert align.check_duplicates("GTAC", "CGTT") is None
+        assert align.check_duplicates(["GTAC"], ["CGTT"]) is None
 
     def test_check_duplicates_MSA_with_no_duplicates(self):
         alignment = MultipleSeqAlignment(
@@ -117,7 +142,7 @@ class TestAlign:
                 SeqRecord(Seq("TAGC"), name="seq3"),
             ]
         )
-        assert align.check_duplicates(alignment) is None
+        assert align.check_duplicates(s.name for s in alignment) is None
 
     def test_check_duplicates_MSA_and_string_with_no_duplicates(self):
         alignment = MultipleSeqAlignment(
@@ -127,11 +152,11 @@ class TestAlign:
                 SeqRecord(Seq("TAGC"), name="seq3"),
             ]
         )
-        assert align.check_duplicates(alignment, "TGTT") is None
+        assert align.check_duplicates([s.name for s in alignment], ["TGTT"]) is None
 
     def test_check_duplicates_string_with_duplicates(self):
         with pytest.raises(align.AlignmentError):
-            assert align.check_duplicates("GTAC", "CGTT", "CGTT")
+            assert align.check_duplicates(["GTAC"], ["CGTT", "CGTT"])
 
     def test_check_duplicates_MSA_with_duplicates(self):
         alignment = MultipleSeqAlignment(
@@ -143,7 +168,7 @@ class TestAlign:
             ]
         )
         with pytest.raises(align.AlignmentError):
-            assert align.check_duplicates(alignment)
+            assert align.check_duplicates(s.name for s in alignment)
 
     def test_check_duplicates_MSA_and_string_with_duplicates(self):
         alignment = MultipleSeqAlignment(
@@ -154,7 +179,7 @@ class TestAlign:
             ]
         )
         with pytest.raises(align.AlignmentError):
-            assert align.check_duplicates(alignment, "seq3")
+            assert align.check_duplicates([s.name for s in alignment], ["seq3"])
 
     def test_prune_seqs_matching_alignment(self):
         sequence = {
@@ -183,6 +208,39 @@ class TestAlign:
         align.prettify_alignment(alignment)
         seqs = {s.id:s for s in alignment}
         assert "crick_strand" in seqs
+        assert seqs["crick_strand"].name == "crick_strand"
+        assert seqs["crick_strand"].description == "crick_strand some description"
+        assert str(seqs["crick_strand"].seq) == "-GGATATAGG-"
+
+    @pytest.mark.parametrize("nthreads", [2, 8])
+    def test_strip_non_reference_threads(self, nthreads):
+        """Splitting the alignment across threads shouldn't change the result"""
+        data_file = str(pathlib.Path('tests/data/align/test_aligned_sequences.fasta').resolve())
+        expected = align.strip_non_reference(list(align.iter_aligner_output(data_file)), "with_gaps")
+        result = align.strip_non_reference(list(align.iter_aligner_output(data_file)), "with_gaps", nthreads=nthreads)
+        assert [(s.name, s.seq) for s in result] == [(s.name, s.seq) for s in expected]
+        assert [s.seq for s in result] == ["ATATA", "ATATA", "ATCTA", "ATATA"]
+
+    def test_strip_insertions(self, tmpdir):
+        """Runs of insertions (w.r.t. the reference) should be removed and reported with their 1-based ref position"""
+        data_file = pathlib.Path('tests/data/align/test_aligned_sequences.fasta')
+        alignment = list(align.iter_aligner_output(str(data_file.resolve())))
+        align.prettify_alignment(alignment)
+        ungapped = np.array([base != "-" for base in "---ATATA---"])
+        insertion_coords = np.stack(align.find_insertion_runs(ungapped), axis=1).tolist()
+        insertions = [defaultdict(list) for _ in insertion_coords]
+        seqs = align.strip_insertions(alignment, ungapped, insertion_coords, insertions)
+        assert [seq.seq for seq in seqs] == ["ATATA", "ATATA", "ATCTA", "ATATA"]
+        insertion_csv = str(tmpdir / "insertions.csv")
+        align.report_insertions(insertion_coords, insertions, insertion_csv)
+        with open(insertion_csv) as fh:
+            lines = fh.read().splitlines()
+        assert lines == [
+            "strain,insertion: 3bp @ ref pos 0,insertion: 3bp @ ref pos 5",
+            "no_gaps,GGG,GGG",
+            "some_other_seq,G,GGG",
+            "crick_strand,GG,GG",
+        ]
 
     def test_generate_alignment_cmd_non_mafft(self):
         with pytest.raises(align.AlignmentError):
@@ -219,22 +277,69 @@ class TestAlign:
         
         assert result == expected
         
+    def test_generate_alignment_cmd_mafft_reference(self):
+        result = align.generate_alignment_cmd("mafft-reference", 4,
+                                              "existing_aln",
+                                              "seqs_to_align",
+                                              "aln_fname",
+                                              "log_fname")
+
+        expected = "mafft --auto --keeplength --anysymbol --addfragments %s --thread %d %s 1> %s 2> %s" % (quote("seqs_to_align"), 4, quote("existing_aln"), quote("aln_fname"), quote("log_fname"))
+
+        assert result == expected
+
+    def test_generate_alignment_cmd_mafft_reference_no_existing_aln_fname(self):
+        with pytest.raises(align.AlignmentError, match="requires an --existing-alignment"):
+            assert align.generate_alignment_cmd("mafft-reference", 1, None, "seqs_to_align", "aln_fname", "log_fname")
+
     def test_read_alignment(self):
         data_file = pathlib.Path('tests/data/align/test_aligned_sequences.fasta')
         result = align.read_alignment(str(data_file.resolve()))
         
         assert len(result) == 4
         
+    def test_iter_aligner_output_line_wrapped(self, tmpdir):
+        """Sequences wrapped over several lines (with any line endings) should be joined back together"""
+        aligned = str(tmpdir / "aligned.fasta")
+        with open(aligned, "wb") as fh:
+            fh.write(b">seq1 some description\nac-\ngt\n>seq2\r\nACG\r\nTA\r\n")
+        result = list(align.iter_aligner_output(aligned))
+        assert [(r.name, r.description, r.seq) for r in result] == [
+            ("seq1", "seq1 some description", "ac-gt"),
+            ("seq2", "seq2", "ACGTA"),
+        ]
+
     def test_read_sequences(self):
         data_file = pathlib.Path('tests/data/align/test_aligned_sequences.fasta')
         result = align.read_sequences(data_file)
         assert len(result) == 4
 
     def test_read_seq_compare(self):
-        data_file = pathlib.Path("tests/data/align/aa-seq_h3n2_ha_2y_2HA1_dup.fasta")
-        with pytest.raises(align.AlignmentError):
+        data_file = pathlib.Path("tests/data/align/aa-seq_h3n2_ha_2y_HA1_dup.fasta")
+        with pytest.raises(align.AlignmentError, match="sequences are different"):
             assert align.read_sequences(data_file)
 
+    def test_read_sequences_identical_duplicates(self, tmpdir, test_file, test_seqs, out_file):
+        """The same strain with the same sequence in two inputs should only be kept once"""
+        # same sequence as in test_file, but line-wrapped differently
+        rewrapped = str(tmpdir / "rewrapped.fasta")
+        with open(rewrapped, "w") as fh:
+            fh.write(">PREFIX\n" + "\n".join(str(test_seqs["PREFIX"].seq)) + "\n")
+        result = align.read_sequences(test_file, rewrapped)
+        assert [r.name for r in result] == list(test_seqs.keys())
+        align.write_seqs(result, out_file)
+        for name, record in SeqIO.to_dict(SeqIO.parse(out_file, "fasta")).items():
+            assert record.seq == test_seqs[name].seq
+
+    def test_read_sequences_duplicates_keep_last(self, tmpdir, out_file):
+        """Of identical duplicates, the last one read is the one written out"""
+        fname = str(tmpdir / "duplicates.fasta")
+        with open(fname, "w") as fh:
+            fh.write(">a\nACGT\n>a other\nAC\nGT\n")
+        align.write_seqs(align.read_sequences(fname), out_file)
+        with open(out_file) as fh:
+            assert fh.read() == ">a other\nAC\nGT\n"
+
     def test_prepare_no_alignment_or_ref(self, test_file, test_seqs, out_file):
         _, output, _ = align.prepare([test_file,], None, out_file, None, None)
         assert os.path.isfile(output), "Didn't write sequences where it said"
@@ -328,6 +433,11 @@ class TestAlign:
         seq_output = SeqIO.to_dict(SeqIO.parse(seq_outfile, "fasta"))
         assert seq_output.keys() == test_seqs.keys(), "Did not strip duplicate sequences from test input!"
     
+    def test_prepare_no_alignment_with_duplicate_ref_file(self, test_with_ref, ref_file, out_file):
+        """Test that a reference sequence which is also in the input sequences is caught as a duplicate."""
+        with pytest.raises(align.AlignmentError, match="Duplicate strains"):
+            align.prepare([test_with_ref,], None, out_file, None, ref_file)
+
     def test_prepare_with_alignment_ref_sequence_wrong_length(self, test_file, existing_file, ref_seq, ref_file):
         """Test that including a reference sequence with a length different than the existing alignment fails."""
         ref_seq.seq = ref_seq.seq[:-3]
@@ -377,6 +487,15 @@ class TestAlign:
         for record in output.values():
             assert len(record.seq) == expected_length
 
+    def test_postprocess_reference_missing(self, existing_file):
+        """Postprocess should fail without touching the alignment if the reference isn't in it"""
+        with open(existing_file) as fh:
+            before = fh.read()
+        with pytest.raises(align.AlignmentError):
+            align.postprocess(existing_file, "missing", True, False)
+        with open(existing_file) as fh:
+            assert fh.read() == before
+
     def test_run_no_ref_or_alignment(self, test_file, test_seqs, ref_seq, out_file, argparser, run):
         """No reference sequence or existing alignment. In this case, all sequences should be the length of the max sequence minus gaps"""
         gaps = ref_seq.seq.count("-")
@@ -421,6 +540,32 @@ class TestAlign:
         assert sorted(output.keys()) == sorted(list(test_seqs.keys()) + list(existing_aln.keys())), "Missing some sequences from input or alignment"
         assert len({len(r.seq) for r in output.values()}) == 1, "Not all sequences are the same length"
     
+    def test_run_partitioned_with_alignment(self, test_seqs, test_file, existing_aln, existing_file, out_file, run):
+        output = run("-s %s --existing-alignment %s --partition-size 2 --nthreads 2" % (test_file, existing_file))
+        assert sorted(output.keys()) == sorted(list(test_seqs.keys()) + list(existing_aln.keys())), "Missing some sequences from input or alignment"
+        assert len({len(r.seq) for r in output.values()}) == 1, "Not all sequences are the same length"
+        assert not any(".part" in fname for fname in os.listdir(os.path.dirname(out_file))), "Partition files were not cleaned up"
+
+    def test_align_partitions_failed_job(self, test_file, existing_file, out_file, mp_context):
+        """A failing job still leaves the combined log behind and removes the partition files"""
+        def failing_shell_command(cmd):
+            log_fname = cmd.split("2> ")[-1].strip("'")
+            with open(log_fname, "w") as fh:
+                fh.write("mafft failed\n")
+            return False
+        mp_context.setattr(align, "run_shell_command", failing_shell_command)
+        log_fname = out_file + ".log"
+        with pytest.raises(align.AlignmentError, match=log_fname):
+            align.align_partitions("mafft", 2, 2, existing_file, test_file, out_file, log_fname)
+        with open(log_fname) as fh:
+            assert fh.read() == "mafft failed\n" * 2
+        assert not any(".part" in fname for fname in os.listdir(os.path.dirname(out_file))), "Partition files were not cleaned up"
+
+    def test_run_partition_size_without_alignment(self, test_file, argparser):
+        args = argparser("-s %s --partition-size 2" % test_file)
+        with pytest.raises(align.AlignmentError):
+            align.check_arguments(args)
+
     def test_run_multiple_sequences_concatenated(self, test_file, test_seqs, ref_file, ref_seq, run):
         output = run("-s %s %s" % (test_file, ref_file))
         assert ref_seq.id in output